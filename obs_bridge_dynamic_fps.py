@@ -13,12 +13,11 @@ import base64
 import sys
 import os
 import ssl
-from PIL import Image
-import io
+import socket
 import time
 import threading
 import queue
-import statistics
+import concurrent.futures
 
 try:
     import pyvirtualcam
@@ -27,24 +26,94 @@ except ImportError:
     os.system("pip install pyvirtualcam")
     import pyvirtualcam
 
+# PyTurboJPEG decodes JPEG ~2x faster and can output any pixel format
+# directly. Fall back to cv2.imdecode if unavailable.
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    TURBOJPEG_AVAILABLE = True
+except (ImportError, OSError):
+    TURBOJPEG_AVAILABLE = False
+
 class OBSVirtualCameraBridge:
     def __init__(self, websocket_url="wss://192.168.0.225:8443/"):
         self.websocket_url = websocket_url
         self.virtual_cam = None
-        self.frame_queue = queue.Queue(maxsize=10)
+        # Single-slot "latest frame" buffer: only the newest frame matters for
+        # a realtime bridge, so an atomic swap beats a queue here
+        self._latest_frame = None
+        self._frame_lock = threading.Lock()
+        # Source JPEG dimensions from the last decode, and when the output
+        # thread last consumed a frame (used to skip decoding doomed frames)
+        self._src_dims = None
+        self._last_consume_ns = 0
         self.running = False
         self.last_frame = None
+        # Input-FPS stats are bumped from the decode workers, so updates go
+        # through a lock (FPS detection itself runs on the event-loop thread)
         self.frame_count = 0
         self.fps_counter = 0
         self.last_fps_time = time.time()
+        self._stats_lock = threading.Lock()
         self.current_resolution = (1280, 720)  # Default resolution
+
+        # Fast JPEG decoder (falls back to cv2.imdecode if turbojpeg is missing)
+        self._tj = None
+        self._tj_scaling_factors = []
+        # decode(dst=...) reuses our buffers instead of allocating per frame;
+        # cleared if the installed PyTurboJPEG doesn't support the parameter
+        self._tj_dst_supported = True
+        if TURBOJPEG_AVAILABLE:
+            try:
+                self._tj = TurboJPEG()
+                # Downscale factors only (upscaling at decode time would cost
+                # more IDCT work than a native 1/1 decode), most aggressive
+                # first (e.g. 1/8 before 1/2)
+                self._tj_scaling_factors = sorted(
+                    set((n, d) for n, d in self._tj.scaling_factors if n <= d),
+                    key=lambda f: f[0] / f[1])
+            except Exception as e:
+                print(f"[WARN] TurboJPEG unavailable, using cv2.imdecode: {e}")
+        # Decode off the asyncio thread: JPEG decode is multi-ms at HD and
+        # would stall the websocket receive loop. TurboJPEG releases the GIL
+        # in C, so N decoders scale near-linearly with cores.
+        decode_workers = min(4, os.cpu_count() or 2)
+        self._decode_pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=decode_workers, thread_name_prefix="jpeg-decode")
+        # Sequence numbers keep parallel decodes ordered: only a frame newer
+        # than the last published one replaces the latest-frame slot
+        self._rx_seq = 0
+        self._published_seq = -1
+
+        # Rotating output buffers so no live frame gets overwritten: at most
+        # decode_workers - 1 other decodes in flight, plus the published
+        # _latest_frame, plus the consumer's last_frame, plus the one being
+        # claimed = decode_workers + 3 buffers needed in the worst case
+        self._tj_buffers = [None] * (decode_workers + 3)
+        self._tj_buf_idx = 0
+        self._buf_lock = threading.Lock()
+
+        # Hot-path stats go through a queue drained by a daemon thread, so
+        # the data threads never block on stdout (which can stall when piped)
+        self._log_q = queue.SimpleQueue()
+        threading.Thread(target=self._log_worker, daemon=True).start()
         
-        # Dynamic FPS detection
+        # Dynamic FPS detection: per-frame cost is one EWMA update; the
+        # detected rate is only re-evaluated every ~500 ms
         self.detected_fps = 30.0
-        self.frame_times = []
-        self.fps_detection_samples = 30  # Sample last 30 frame intervals
+        self._ewma_interval = 0.0
+        self._ewma_samples = 0
+        self._last_eval_time = time.time()
         self.last_frame_time = time.time()
         
+    def _log_worker(self):
+        """Print messages queued from the hot paths"""
+        while True:
+            print(self._log_q.get())
+
+    def _log(self, message):
+        """Queue a log line without blocking the calling thread"""
+        self._log_q.put_nowait(message)
+
     async def connect_websocket(self):
         """Connect to WebSocket server and receive frames"""
         print(f"Connecting to WebSocket: {self.websocket_url}")
@@ -55,21 +124,51 @@ class OBSVirtualCameraBridge:
             ssl_context.check_hostname = False
             ssl_context.verify_mode = ssl.CERT_NONE
             
-            async with websockets.connect(self.websocket_url, ssl=ssl_context) as websocket:
+            # JPEG frames are already compressed, so permessage-deflate only
+            # burns CPU on both ends; max_size=None keeps >1 MiB HD frames
+            # from killing the connection, and a small max_queue applies
+            # backpressure instead of buffering unboundedly when we slow down
+            async with websockets.connect(self.websocket_url, ssl=ssl_context,
+                                          compression=None, max_size=None,
+                                          max_queue=4) as websocket:
                 print("[SUCCESS] Connected to WebSocket server")
-                
-                async for message in websocket:
-                    if not self.running:
-                        break
-                        
+                loop = asyncio.get_running_loop()
+
+                # Disable Nagle (no coalescing delay between frames) and grow
+                # the receive buffer so multi-MTU JPEG frames arrive in fewer
+                # recv() wakeups
+                try:
+                    sock = websocket.transport.get_extra_info('socket')
+                    if sock is not None:
+                        sock.setsockopt(socket.IPPROTO_TCP,
+                                        socket.TCP_NODELAY, 1)
+                        sock.setsockopt(socket.SOL_SOCKET,
+                                        socket.SO_RCVBUF, 4 * 1024 * 1024)
+                except Exception as e:
+                    print(f"[WARN] Could not tune socket options: {e}")
+
+                # Binary-only fast path: recv() directly instead of the
+                # async-iterator protocol, one await per frame
+                while self.running:
+                    message = await websocket.recv()
+
                     try:
                         # Handle binary data (JPEG frames)
-                        if isinstance(message, bytes):
-                            self.process_frame(message)
+                        if isinstance(message, (bytes, bytearray)):
+                            # Measure frame timing here on the loop thread:
+                            # intervals reflect arrival, not worker start, and
+                            # the EWMA state stays single-threaded
+                            self.detect_fps()
+                            # Fire-and-forget: decode in the pool so the event
+                            # loop only ships bytes and never stalls on decode
+                            self._rx_seq += 1
+                            loop.run_in_executor(self._decode_pool,
+                                                 self.process_frame, message,
+                                                 self._rx_seq)
                         else:
                             # Handle text messages
                             print(f"Received text message: {message}")
-                            
+
                     except Exception as e:
                         print(f"Error processing frame: {e}")
                         continue
@@ -85,65 +184,162 @@ class OBSVirtualCameraBridge:
         frame_interval = current_time - self.last_frame_time
         self.last_frame_time = current_time
         
-        # Add to frame times list
         if frame_interval > 0.001:  # Ignore very small intervals
-            self.frame_times.append(frame_interval)
-            
-            # Keep only recent samples
-            if len(self.frame_times) > self.fps_detection_samples:
-                self.frame_times.pop(0)
-            
-            # Calculate average FPS from recent samples
-            if len(self.frame_times) >= 10:  # Need at least 10 samples
-                avg_interval = statistics.mean(self.frame_times)
-                new_fps = 1.0 / avg_interval
-                
+            # EWMA of recent intervals: O(1), no buffer to maintain
+            if self._ewma_samples == 0:
+                self._ewma_interval = frame_interval
+            else:
+                self._ewma_interval = (0.9 * self._ewma_interval +
+                                       0.1 * frame_interval)
+            self._ewma_samples += 1
+
+            # Re-evaluate the detected rate at ~2 Hz, not per frame
+            if (self._ewma_samples >= 10 and
+                    current_time - self._last_eval_time >= 0.5):
+                self._last_eval_time = current_time
+                new_fps = 1.0 / self._ewma_interval
+
                 # Only update if FPS changed significantly (>2 FPS difference)
                 if abs(new_fps - self.detected_fps) > 2:
                     old_fps = self.detected_fps
                     self.detected_fps = round(new_fps, 1)
-                    print(f"[FPS] Detected frame rate change: {old_fps} → {self.detected_fps} FPS")
+                    self._log(f"[FPS] Detected frame rate change: {old_fps} → {self.detected_fps} FPS")
                     return True
-                    
+
         return False
-            
-    def process_frame(self, frame_data):
-        """Process incoming frame data and detect resolution/FPS"""
+
+    def _pick_scaling_factor(self, jpeg_width, jpeg_height):
+        """Pick the largest decode-time downscale that still covers the camera resolution
+
+        Sources already at or below the target fall through to (1, 1) and
+        decode at their native size.
+        """
+        target_w, target_h = self.current_resolution
+        for num, denom in self._tj_scaling_factors:
+            # TJSCALED: turbojpeg rounds scaled dimensions up
+            scaled_w = (jpeg_width * num + denom - 1) // denom
+            scaled_h = (jpeg_height * num + denom - 1) // denom
+            if scaled_w >= target_w and scaled_h >= target_h:
+                return (num, denom)
+        return (1, 1)
+
+    @staticmethod
+    def _peek_jpeg_dims(buf):
+        """Read dimensions from the JPEG SOF marker without decoding"""
+        i = 2  # skip SOI
+        end = len(buf) - 9
+        while i < end:
+            if buf[i] != 0xFF:
+                i += 1
+                continue
+            marker = buf[i + 1]
+            if 0xC0 <= marker <= 0xC3:  # SOF0..SOF3
+                height = (buf[i + 5] << 8) | buf[i + 6]
+                width = (buf[i + 7] << 8) | buf[i + 8]
+                return (width, height)
+            if marker == 0x01 or 0xD0 <= marker <= 0xD8:  # standalone markers
+                i += 2
+                continue
+            i += 2 + ((buf[i + 2] << 8) | buf[i + 3])
+        return None
+
+    def _decode_into(self, frame_data, jpeg_width, jpeg_height, sf):
+        """Decode a JPEG into a reused rotating buffer (no per-frame allocation)"""
+        num, denom = sf
+        scaled_w = (jpeg_width * num + denom - 1) // denom
+        scaled_h = (jpeg_height * num + denom - 1) // denom
+
+        # Claim a buffer under the lock so concurrent decodes get distinct ones
+        with self._buf_lock:
+            idx = self._tj_buf_idx
+            self._tj_buf_idx = (idx + 1) % len(self._tj_buffers)
+        buf = self._tj_buffers[idx]
+        if buf is None or buf.shape[0] != scaled_h or buf.shape[1] != scaled_w:
+            buf = np.empty((scaled_h, scaled_w, 3), dtype=np.uint8)
+            self._tj_buffers[idx] = buf
+
+        self._tj.decode(frame_data, pixel_format=TJPF_RGB,
+                        scaling_factor=sf, dst=buf)
+        return buf
+
+    def process_frame(self, frame_data, seq=0):
+        """Decode incoming frame data and detect resolution changes"""
         try:
-            # Detect FPS from frame timing
-            fps_changed = self.detect_fps()
-            
+            # If an undelivered frame is already waiting and the output thread
+            # has stalled for over a frame period, this frame is doomed to be
+            # dropped anyway -- a header peek (microseconds) instead of a full
+            # decode is all it costs, unless the source resolution changed
+            if self._latest_frame is not None:
+                stall_ns = time.monotonic_ns() - self._last_consume_ns
+                if stall_ns > int(1e9 / max(self.detected_fps, 1.0)):
+                    dims = self._peek_jpeg_dims(frame_data)
+                    if dims is not None and dims == self._src_dims:
+                        with self._stats_lock:
+                            self.frame_count += 1
+                        return
+
             # Convert JPEG bytes to OpenCV image
-            image = Image.open(io.BytesIO(frame_data))
-            frame = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-            
-            # Check if resolution changed
+            if self._tj is not None:
+                # TurboJPEG decodes straight to RGB (what pyvirtualcam wants),
+                # so no colorspace pass is needed anywhere in the pipeline.
+                # Downscale during decode (IDCT scaling) instead of decoding at
+                # full phone resolution and resizing afterwards.
+                jpeg_width, jpeg_height, _, _ = self._tj.decode_header(frame_data)
+                src_dims = (jpeg_width, jpeg_height)
+                sf = self._pick_scaling_factor(jpeg_width, jpeg_height)
+                if self._tj_dst_supported:
+                    try:
+                        frame = self._decode_into(frame_data, jpeg_width,
+                                                  jpeg_height, sf)
+                    except TypeError as e:
+                        # Older PyTurboJPEG without the dst= parameter
+                        print(f"[WARN] Buffered decode unsupported ({e}), using allocating decode")
+                        self._tj_dst_supported = False
+                        frame = self._tj.decode(frame_data, pixel_format=TJPF_RGB,
+                                                scaling_factor=sf)
+                else:
+                    frame = self._tj.decode(frame_data, pixel_format=TJPF_RGB,
+                                            scaling_factor=sf)
+            else:
+                # OpenCV decodes via its bundled libjpeg-turbo: one call, no
+                # Pillow round-trip, and frombuffer aliases the bytes
+                frame = cv2.imdecode(np.frombuffer(frame_data, np.uint8),
+                                     cv2.IMREAD_COLOR)
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                src_dims = (frame.shape[1], frame.shape[0])
+
             new_resolution = (frame.shape[1], frame.shape[0])  # (width, height)
-            resolution_changed = new_resolution != self.current_resolution
-            
+
+            # Publish latest frame (silently replaces any unconsumed one);
+            # parallel decodes can finish out of order, so a frame older than
+            # the last published one is discarded here. The resolution
+            # metadata is updated under the same gate so a stale decode can't
+            # roll it back after a newer frame already landed.
+            resolution_changed = False
+            old_resolution = None
+            with self._frame_lock:
+                if seq >= self._published_seq:
+                    if new_resolution != self.current_resolution:
+                        resolution_changed = True
+                        old_resolution = self.current_resolution
+                        self.current_resolution = new_resolution
+                    self._src_dims = src_dims
+                    self._latest_frame = frame
+                    self._published_seq = seq
             if resolution_changed:
-                print(f"[RESOLUTION] Changed from {self.current_resolution} to {new_resolution}")
-                self.current_resolution = new_resolution
-            
-            # Add to frame queue (non-blocking)
-            try:
-                self.frame_queue.put_nowait(frame)
-            except queue.Full:
-                # Remove old frame and add new one
-                try:
-                    self.frame_queue.get_nowait()
-                    self.frame_queue.put_nowait(frame)
-                except queue.Empty:
-                    pass
+                self._log(f"[RESOLUTION] Changed from {old_resolution} to {new_resolution}")
             
             # Update FPS counter
-            self.frame_count += 1
-            current_time = time.time()
-            if current_time - self.last_fps_time >= 2.0:  # Report every 2 seconds
-                input_fps = self.frame_count / 2.0
-                self.frame_count = 0
-                self.last_fps_time = current_time
-                print(f"[VIDEO] Input: {input_fps:.1f} FPS, Detected: {self.detected_fps:.1f} FPS, Resolution: {new_resolution[0]}x{new_resolution[1]}, Queue: {self.frame_queue.qsize()}")
+            input_fps = None
+            with self._stats_lock:
+                self.frame_count += 1
+                current_time = time.time()
+                if current_time - self.last_fps_time >= 2.0:  # Report every 2 seconds
+                    input_fps = self.frame_count / 2.0
+                    self.frame_count = 0
+                    self.last_fps_time = current_time
+            if input_fps is not None:
+                self._log(f"[VIDEO] Input: {input_fps:.1f} FPS, Detected: {self.detected_fps:.1f} FPS, Resolution: {new_resolution[0]}x{new_resolution[1]}")
                 
         except Exception as e:
             print(f"Error processing frame: {e}")
@@ -151,79 +347,102 @@ class OBSVirtualCameraBridge:
     def virtual_camera_thread(self):
         """Thread to handle virtual camera output"""
         print("[CAMERA] Starting OBS Virtual Camera...")
-        
-        try:
-            # Start with default resolution
+
+        # Outer loop: recreate the camera whenever the source resolution
+        # diverges from the camera's, instead of resizing every frame forever
+        while self.running:
             width, height = self.current_resolution
             current_fps = self.detected_fps
-            
-            with pyvirtualcam.Camera(width=width, height=height, fps=int(current_fps), device='OBS Virtual Camera') as cam:
-                print(f"[SUCCESS] OBS Virtual Camera started: {width}x{height} @ {int(current_fps)}fps")
-                self.virtual_cam = cam
-                
-                # Create a default frame
-                default_frame = np.zeros((height, width, 3), dtype=np.uint8)
-                cv2.putText(default_frame, "Waiting for phone camera...", 
-                           (width//2-200, height//2), cv2.FONT_HERSHEY_SIMPLEX, 
-                           1, (255, 255, 255), 2)
-                
-                frame_time = 1.0 / current_fps
-                last_time = time.time()
-                output_fps_count = 0
-                last_output_fps_time = time.time()
-                
-                while self.running:
-                    try:
-                        # Check if FPS changed significantly
-                        if abs(self.detected_fps - current_fps) > 2:
-                            print(f"[CAMERA] FPS changed from {current_fps} to {self.detected_fps}, adapting...")
-                            current_fps = self.detected_fps
-                            frame_time = 1.0 / current_fps
-                        
-                        # Get frame from queue or use last frame
-                        frame = None
+
+            try:
+                with pyvirtualcam.Camera(width=width, height=height, fps=int(current_fps), device='OBS Virtual Camera') as cam:
+                    print(f"[SUCCESS] OBS Virtual Camera started: {width}x{height} @ {int(current_fps)}fps")
+                    self.virtual_cam = cam
+
+                    # Cache the "waiting" frame once (RGB, already at camera
+                    # size, so the idle path sends it directly)
+                    self._default_rgb = np.zeros((height, width, 3), dtype=np.uint8)
+                    cv2.putText(self._default_rgb, "Waiting for phone camera...",
+                               (width//2-200, height//2), cv2.FONT_HERSHEY_SIMPLEX,
+                               1, (255, 255, 255), 2)
+
+                    # Deadline-based pacing on the monotonic clock: no
+                    # wall-clock jumps (NTP) and no sleep-overshoot drift
+                    frame_interval_ns = int(1e9 / current_fps)
+                    next_deadline = time.monotonic_ns()
+                    output_fps_count = 0
+                    last_output_ns = next_deadline
+
+                    # Hoist the send bound-method; frames are guaranteed to
+                    # match the camera size (a mismatch recreates the camera)
+                    _send = cam.send
+
+                    while self.running:
                         try:
-                            frame = self.frame_queue.get_nowait()
-                            self.last_frame = frame
-                        except queue.Empty:
-                            frame = self.last_frame if self.last_frame is not None else default_frame
-                        
-                        # Handle resolution changes
-                        if frame is not None and frame.shape[:2] != (height, width):
-                            # Resize frame to match camera (for now)
-                            # TODO: Recreate camera with new resolution
-                            frame = cv2.resize(frame, (width, height))
-                        
-                        # Convert BGR to RGB for pyvirtualcam
-                        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-                        
-                        # Send to virtual camera
-                        cam.send(frame_rgb)
-                        
-                        # Count output FPS
-                        output_fps_count += 1
-                        current_time = time.time()
-                        if current_time - last_output_fps_time >= 2.0:  # Report every 2 seconds
-                            actual_output_fps = output_fps_count / 2.0
-                            print(f"[OUTPUT] Virtual Camera: {actual_output_fps:.1f} FPS (target: {current_fps:.1f})")
-                            output_fps_count = 0
-                            last_output_fps_time = current_time
-                        
-                        # Maintain frame rate based on detected FPS
-                        elapsed = current_time - last_time
-                        if elapsed < frame_time:
-                            time.sleep(frame_time - elapsed)
-                        last_time = time.time()
-                        
-                    except Exception as e:
-                        print(f"Virtual camera error: {e}")
-                        break
-                        
-        except Exception as e:
-            print(f"[ERROR] Failed to start virtual camera: {e}")
-            print("Make sure OBS Virtual Camera is installed and available")
-            return False
-            
+                            # Check if FPS changed significantly
+                            if abs(self.detected_fps - current_fps) > 2:
+                                self._log(f"[CAMERA] FPS changed from {current_fps} to {self.detected_fps}, adapting...")
+                                current_fps = self.detected_fps
+                                frame_interval_ns = int(1e9 / current_fps)
+
+                            # Take the latest frame, or repeat the last one
+                            with self._frame_lock:
+                                new_frame = self._latest_frame
+                                self._latest_frame = None
+                            if new_frame is not None:
+                                self.last_frame = new_frame
+                                # Never send a mismatched frame to the camera
+                                if new_frame.shape[:2] != (height, width):
+                                    # Source changed size: recreate the camera
+                                    # at the new resolution rather than
+                                    # resizing every frame
+                                    self._log(f"[CAMERA] Recreating camera at {self.current_resolution}...")
+                                    break
+                            frame = self.last_frame
+
+                            if frame is None:
+                                # Idle: cached default frame, already RGB
+                                _send(self._default_rgb)
+                            else:
+                                # Frames are RGB end-to-end, send directly
+                                _send(frame)
+
+                            # One clock read per iteration drives the consume
+                            # stamp, the stats window and the pacing deadline
+                            now = time.monotonic_ns()
+                            if new_frame is not None:
+                                self._last_consume_ns = now
+
+                            # Count output FPS (report every 2 seconds)
+                            output_fps_count += 1
+                            elapsed_ns = now - last_output_ns
+                            if elapsed_ns >= 2_000_000_000:
+                                actual_output_fps = output_fps_count * 1e9 / elapsed_ns
+                                self._log(f"[OUTPUT] Virtual Camera: {actual_output_fps:.1f} FPS (target: {current_fps:.1f})")
+                                output_fps_count = 0
+                                last_output_ns = now
+
+                            # Maintain frame rate: sleep until the next deadline
+                            next_deadline += frame_interval_ns
+                            slack = next_deadline - now
+                            if slack > 0:
+                                time.sleep(slack / 1e9)
+                            else:
+                                # Fell behind, don't burst to catch up
+                                next_deadline = now
+
+                        except Exception as e:
+                            print(f"Virtual camera error: {e}")
+                            # Recreate the camera rather than dying; pause so
+                            # a persistent failure can't spin
+                            time.sleep(0.5)
+                            break
+
+            except Exception as e:
+                print(f"[ERROR] Failed to start virtual camera: {e}")
+                print("Make sure OBS Virtual Camera is installed and available")
+                return False
+
         print("[CAMERA] Virtual camera stopped")
         return True
     
@@ -265,7 +484,16 @@ def main():
     print("OBS Virtual Camera Bridge - Dynamic FPS Matching")
     print("Automatically matches your phone camera's frame rate")
     print("=" * 65)
-    
+
+    # uvloop roughly doubles websockets throughput; POSIX-only, so Windows
+    # silently stays on the stock asyncio loop
+    try:
+        import uvloop
+        uvloop.install()
+        print("[LOOP] Using uvloop event loop")
+    except ImportError:
+        pass
+
     bridge = OBSVirtualCameraBridge()
     
     try: